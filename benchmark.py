@@ -0,0 +1,604 @@
+"""
+Offline replay benchmark for StackedBot
+
+Drives on_message, on_raw_reaction_add and send_notification with synthetic
+or recorded traffic through fake guild, channel and member objects. External
+services are replaced by local stubs, so no network or Discord token is
+needed.
+
+    python benchmark.py --events 2000 --service-latency 0.002
+    python benchmark.py --guilds 50 --members 500
+    python benchmark.py --replay traffic.jsonl --json bench.json
+    python benchmark.py --baseline bench.json
+
+A recorded traffic file has one JSON event per line:
+
+    {"type": "message", "content": "!whatis kvk"}
+    {"type": "message", "content": "<@1> hi there", "mention": true}
+    {"type": "message", "content": "hello", "private": true}
+    {"type": "reaction", "emoji": "🇫🇷", "content": "good morning"}
+    {"type": "notification", "region": "EU", "message": "mystical"}
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+# Ids of the fake guild objects, offset by GUILD_ID_STRIDE for every guild
+ROLE_IDS = {"eu_role": 101, "na_role": 102}
+CHANNEL_IDS = {"public_eu_channel": 201, "public_na_channel": 202, "lobby_channel": 203}
+GUILD_ID_STRIDE = 1000
+
+# Guild config and snapshot files of the run, removed once it is done
+STATE_DIR = tempfile.mkdtemp(prefix="stackedbot-bench-")
+# Empty, not unset, so load_dotenv does not bring them back from .env
+for key in ROLE_IDS.keys() | CHANNEL_IDS.keys():
+    os.environ[key.upper()] = ""
+for key in ("METRICS_PORT", "ADMIN_IDS", "PERSIST_INTERVAL", "REMINDER_GUILD"):
+    os.environ[key] = ""
+os.environ["GUILDCONFIGFILE"] = os.path.join(STATE_DIR, "guilds.json")
+
+import stackedBot  # noqa: E402
+
+BOT_ID = 1
+
+COMMANDS = [
+    "!help",
+    "!event",
+    "!events na",
+    "!kvkcalc 1000 900 10 12 8 7 5 6",
+    "!kvkcalc 1000 900 10 12 8 7 5 6 true na",
+    "!whatis kvk",
+    "!whatis bog",
+    "!addis bog battle of gods",
+    "!lookup dragon",
+    "!urban stacked",
+    "!inspireme",
+    "!remindme emblem",
+    "!remindme mystical",
+]
+
+CHATTER = [
+    "anyone up for the dragon tonight?",
+    "> quoted message\nthat was a good one",
+    "gg everyone, we won kvk",
+    "what time is the arena reset",
+    "@Deathwing can you check the roster",
+    "lol",
+]
+
+FLAGS = ["🇫🇷", "🇩🇪", "🇪🇸", "🇮🇹", "🇯🇵", "🇧🇷", "🇷🇴"]
+
+NOTIFICATIONS = [
+    ("EU", "Energy to be claimed! Go go!"),
+    ("NA", "Guild reward packs! Go claim some lewt!"),
+    ("EU", "mystical"),
+    ("NA", "emblem"),
+]
+
+
+# Stand-ins for the external services, blocking like the real clients
+class Services:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class StubWikipedia:
+    def __init__(self, services):
+        self.services = services
+
+    def summary(self, keyword):
+        self.services.wait()
+        return f"{keyword.capitalize()} is a thing. It has a long article."
+
+    def search(self, keyword):
+        self.services.wait()
+        return [keyword]
+
+
+class StubResponse:
+    def __init__(self, term):
+        self.content = json.dumps(
+            {
+                "list": [
+                    {"definition": f"{term}, but more", "example": term, "thumbs_up": 3},
+                    {"definition": f"{term}, again", "example": term, "thumbs_up": 1},
+                ]
+            }
+        )
+
+
+class StubRequests:
+    def __init__(self, services):
+        self.services = services
+
+    def request(self, method, url, headers=None, params=None):
+        self.services.wait()
+        return StubResponse(params["term"])
+
+
+class StubQuote:
+    url = "https://generated.inspirobot.me/a/stub.jpg"
+
+
+class StubInspirobot:
+    def __init__(self, services):
+        self.services = services
+
+    def generate(self):
+        self.services.wait()
+        return StubQuote()
+
+
+class StubTranslation:
+    def __init__(self, text, dest):
+        self.text = text
+        self.dest = dest
+
+
+class StubTranslator:
+    def __init__(self, services):
+        self.services = services
+
+    def translate(self, text, dest):
+        self.services.wait()
+        return StubTranslation(text[::-1], dest)
+
+
+# The chatbot lives in another process, so it only costs the bot a round trip
+class StubChatbotClient:
+    def __init__(self, services):
+        self.services = services
+        self.trained = 0
+
+    def train(self, line):
+        self.trained += 1
+
+    async def respond(self, text):
+        self.services.calls += 1
+        if self.services.latency:
+            await asyncio.sleep(self.services.latency)
+        return f"you said {text}"
+
+    async def close(self):
+        pass
+
+
+# Fake Discord objects, just what the bot touches
+class FakeRole:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.mention = f"<@&{id}>"
+
+
+class FakeMember:
+    def __init__(self, id, name, roles, nick=None, delivery=0.0):
+        self.id = id
+        self.name = name
+        self.nick = nick
+        self.display_name = nick or name
+        self.mention = f"<@{id}>"
+        self.roles = roles
+        self.guild_permissions = discord.Permissions.none()
+        self.delivery = delivery
+        self.received = 0
+
+    async def send(self, content):
+        if self.delivery:
+            await asyncio.sleep(self.delivery)
+        self.received += 1
+
+    async def add_roles(self, role):
+        self.roles.append(role)
+
+    async def remove_roles(self, role):
+        self.roles.remove(role)
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeReaction:
+    def __init__(self, emoji):
+        self.emoji = emoji
+        self.count = 1
+
+
+class FakeMessage:
+    def __init__(self, id, content, author, channel, mentions=(), guild=None):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = list(mentions)
+        self.guild = guild
+        self.reactions = []
+
+
+class FakeChannel:
+    def __init__(self, id, name, type=discord.ChannelType.text, delivery=0.0, guild=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.guild = guild
+        self.delivery = delivery
+        self.messages = {}
+        self.sent = 0
+
+    async def send(self, content):
+        if self.delivery:
+            await asyncio.sleep(self.delivery)
+        self.sent += 1
+
+    async def fetch_message(self, id):
+        return self.messages[id]
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, id, roles, channels, members):
+        self.id = id
+        self.name = f"guild{id}"
+        self.roles = {role.id: role for role in roles}
+        self.channels = {channel.id: channel for channel in channels}
+        self.members = list(members)
+        self.members_by_id = {member.id: member for member in members}
+        self.default_role = FakeRole(id, "@everyone")
+        for channel in channels:
+            channel.guild = self
+
+    def get_role(self, id):
+        return self.roles.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    def get_member(self, id):
+        return self.members_by_id.get(id)
+
+
+class FakeReactionEvent:
+    def __init__(self, emoji, channel_id, message_id):
+        self.emoji = discord.PartialEmoji(name=emoji)
+        self.channel_id = channel_id
+        self.message_id = message_id
+
+
+class BenchBot(stackedBot.StackedBot):
+    """StackedBot wired to fake guilds instead of the gateway"""
+
+    def __init__(self, guilds, user):
+        super().__init__()
+        self.fake_guilds = guilds
+        self.fake_channels = {
+            channel.id: channel for guild in guilds for channel in guild.channels.values()
+        }
+        self.fake_user = user
+
+    @property
+    def user(self):
+        return self.fake_user
+
+    @property
+    def guilds(self):
+        return self.fake_guilds
+
+    def get_channel(self, id):
+        return self.fake_channels.get(id)
+
+
+def install_stubs(services):
+    stackedBot.wikipedia = StubWikipedia(services)
+    stackedBot.requests = StubRequests(services)
+    stackedBot.inspirobot = StubInspirobot(services)
+
+
+def build_guild(index, args):
+    offset = index * GUILD_ID_STRIDE
+    roles = [FakeRole(offset + id, name) for name, id in ROLE_IDS.items()]
+    channels = [
+        FakeChannel(offset + id, name, delivery=args.send_latency)
+        for name, id in CHANNEL_IDS.items()
+    ]
+    members = [
+        FakeMember(
+            offset * GUILD_ID_STRIDE + 1000 + i,
+            f"player{i}",
+            [roles[i % len(roles)]],
+            nick=f"Player {i}" if i % 3 == 0 else None,
+            delivery=args.send_latency,
+        )
+        for i in range(args.members)
+    ]
+    return FakeGuild(offset + 42, roles, channels, members)
+
+
+# Fake guilds, and the configuration StackedBot reads for them
+def build_world(args):
+    guilds = [build_guild(index, args) for index in range(args.guilds)]
+    config = {}
+    for index, guild in enumerate(guilds):
+        offset = index * GUILD_ID_STRIDE
+        config[guild.id] = {
+            key: offset + id for key, id in {**ROLE_IDS, **CHANNEL_IDS}.items()
+        }
+    with open(os.environ["GUILDCONFIGFILE"], "w") as fp:
+        json.dump(config, fp)
+
+    user = FakeMember(BOT_ID, "Stacked", [])
+    return guilds, user
+
+
+def synthetic_traffic(count, seed):
+    rng = random.Random(seed)
+    events = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.35:
+            events.append({"type": "message", "content": rng.choice(COMMANDS)})
+        elif roll < 0.5:
+            events.append(
+                {
+                    "type": "message",
+                    "content": f"<@{BOT_ID}> {rng.choice(CHATTER)}",
+                    "mention": True,
+                }
+            )
+        elif roll < 0.55:
+            events.append(
+                {"type": "message", "content": rng.choice(CHATTER), "private": True}
+            )
+        elif roll < 0.85:
+            events.append({"type": "message", "content": rng.choice(CHATTER)})
+        elif roll < 0.97:
+            events.append(
+                {
+                    "type": "reaction",
+                    "emoji": rng.choice(FLAGS),
+                    "content": rng.choice(CHATTER),
+                }
+            )
+        else:
+            region, message = rng.choice(NOTIFICATIONS)
+            events.append({"type": "notification", "region": region, "message": message})
+    return events
+
+
+def load_traffic(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+class Driver:
+    """Turns traffic events into handler calls"""
+
+    def __init__(self, bot, guilds, rng):
+        self.bot = bot
+        self.guilds = guilds
+        self.rng = rng
+        self.next_id = 1
+
+    def message(self, event):
+        guild = self.rng.choice(self.guilds)
+        author = self.rng.choice(guild.members)
+        if event.get("private"):
+            channel = FakeChannel(
+                1000000 + author.id, "dm", type=discord.ChannelType.private
+            )
+            guild = None
+        else:
+            offset = guild.id - 42
+            channel = guild.get_channel(
+                offset + self.rng.choice(
+                    [CHANNEL_IDS["public_eu_channel"], CHANNEL_IDS["public_na_channel"]]
+                )
+            )
+        mentions = [self.bot.user] if event.get("mention") else []
+        message = FakeMessage(
+            self.next_id, event["content"], author, channel, mentions, guild
+        )
+        self.next_id += 1
+        return message
+
+    def handler(self, event):
+        kind = event["type"]
+        if kind == "message":
+            return "on_message", self.bot.on_message(self.message(event))
+        if kind == "reaction":
+            message = self.message(event)
+            message.reactions.append(FakeReaction(event["emoji"]))
+            message.channel.messages[message.id] = message
+            reaction = FakeReactionEvent(event["emoji"], message.channel.id, message.id)
+            return "on_raw_reaction_add", self.bot.on_raw_reaction_add(reaction)
+        if kind == "notification":
+            region = stackedBot.Region[event["region"]]
+            text = event["message"]
+            channelId = None
+            if text not in self.bot.remind_me:
+                channelId = stackedBot.REGION_CONFIGS[region]["channelId"]
+            return (
+                "send_notification",
+                self.bot.send_notification(channelId, region, text),
+            )
+        raise ValueError(f"Unknown event type {kind}")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+# Replays the events against a fresh bot, with state files in their own directory
+async def replay(args, events, services):
+    state_dir = tempfile.mkdtemp(dir=STATE_DIR)
+    os.environ["WHATISFILE"] = os.path.join(state_dir, "whatis")
+    os.environ["REMINDERFILE"] = os.path.join(state_dir, "reminder")
+    guilds, user = build_world(args)
+
+    bot = BenchBot(guilds, user)
+    bot.translator = StubTranslator(services)
+    bot.chatbot = StubChatbotClient(services)
+    await bot.on_ready()
+    for cron in bot.cronTab:
+        cron.stop()
+    bot.lag_monitor.stop()
+
+    # Everyone subscribes to the store reminders
+    for event_name in ("emblem", "mystical"):
+        bot.remind_me[event_name] = {
+            guild.id: {member.id for member in guild.members} for guild in guilds
+        }
+
+    driver = Driver(bot, guilds, random.Random(args.seed))
+    latencies = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def timed(name, coro):
+        async with semaphore:
+            start = time.perf_counter()
+            await coro
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(*driver.handler(event)) for event in events))
+    handled = time.perf_counter() - start
+    await bot.outbound.join()
+    elapsed = time.perf_counter() - start
+    await bot.persister.stop()
+    return latencies, handled, elapsed, bot.outbound.sent
+
+
+async def run(args, events):
+    services = Services(args.service_latency)
+    install_stubs(services)
+
+    # Timed pass, tracemalloc would slow every handler down several times
+    latencies, handled, elapsed, sends = await replay(args, events, services)
+    service_calls = services.calls
+
+    # Separate pass for the peak memory
+    tracemalloc.start()
+    await replay(args, events, services)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    everything = [value for values in latencies.values() for value in values]
+    report = {
+        "events": len(events),
+        "seconds": elapsed,
+        "throughput": len(events) / handled if handled else 0.0,
+        "p50": percentile(everything, 0.5),
+        "p99": percentile(everything, 0.99),
+        "handlers": {
+            name: {
+                "count": len(values),
+                "p50": percentile(values, 0.5),
+                "p99": percentile(values, 0.99),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        "service_calls": service_calls,
+        "sends": sends,
+        "peak_traced_bytes": peak,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    return report
+
+
+def print_report(report):
+    print(f"events:        {report['events']}")
+    print(f"wall time:     {report['seconds']:.3f}s")
+    print(f"throughput:    {report['throughput']:.1f} events/s")
+    print(f"latency p50:   {report['p50'] * 1000:.3f}ms")
+    print(f"latency p99:   {report['p99'] * 1000:.3f}ms")
+    for name, stats in report["handlers"].items():
+        print(
+            f"  {name:<20} {stats['count']:>6} calls  "
+            f"p50 {stats['p50'] * 1000:.3f}ms  p99 {stats['p99'] * 1000:.3f}ms"
+        )
+    print(f"service calls: {report['service_calls']}")
+    print(f"sends:         {report['sends']}")
+    print(f"peak memory:   {report['peak_traced_bytes'] / 1024:.1f}KiB traced, "
+          f"{report['max_rss_kb'] / 1024:.1f}MiB max RSS")
+
+
+# Returns the list of regressions against a previous report
+def compare(report, baseline, tolerance):
+    regressions = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {report['throughput']:.1f} < {baseline['throughput']:.1f}"
+        )
+    for key in ("p50", "p99", "peak_traced_bytes"):
+        if report[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {report[key]:.6g} > {baseline[key]:.6g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=1000, help="synthetic events")
+    parser.add_argument("--replay", help="recorded traffic, one JSON event per line")
+    parser.add_argument("--guilds", type=int, default=1, help="number of guilds")
+    parser.add_argument("--members", type=int, default=200, help="guild size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="events handled at the same time")
+    parser.add_argument("--service-latency", type=float, default=0.0,
+                        help="seconds each stubbed service call blocks")
+    parser.add_argument("--send-latency", type=float, default=0.0,
+                        help="seconds each Discord send takes")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="fail on regressions against this report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.replay:
+        events = load_traffic(args.replay)
+    else:
+        events = synthetic_traffic(args.events, args.seed)
+
+    try:
+        report = asyncio.run(run(args, events))
+    finally:
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
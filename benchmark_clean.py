@@ -0,0 +1,216 @@
+"""
+Microbenchmark for message cleaning
+
+Compares message_cleaner.clean_message with the old StackedBot.clean_message,
+which worked on discord.py's Message.clean_content, on chat-like messages in
+a guild of --members members.
+
+    python benchmark_clean.py --members 500 --messages 20000
+"""
+import argparse
+import random
+import re
+import time
+
+from message_cleaner import clean_message
+
+WORDS = [
+    "dragon", "tonight", "kvk", "rewards", "arena", "roster", "gg", "lol",
+    "who", "is", "up", "for", "the", "siege", "bets", "placed", "sphinx",
+    "trivia", "answer", "emblem", "store", "refresh", "thanks", "go", "go",
+]
+
+
+class Member:
+    def __init__(self, id, name, nick=None):
+        self.id = id
+        self.name = name
+        self.nick = nick
+        self.display_name = nick or name
+
+
+class Role:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class Channel:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class Guild:
+    def __init__(self, members, roles, channels):
+        self.members = {member.id: member for member in members}
+        self.roles = {role.id: role for role in roles}
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+    def get_role(self, id):
+        return self.roles.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+
+class Message:
+    def __init__(self, content, guild, mentions=(), role_mentions=(), channel_mentions=()):
+        self.content = content
+        self.guild = guild
+        self.mentions = list(mentions)
+        self.role_mentions = list(role_mentions)
+        self.channel_mentions = list(channel_mentions)
+
+    # discord.py 1.7 Message.clean_content, without the per message caching
+    @property
+    def clean_content(self):
+        transformations = {
+            re.escape("<#%s>" % channel.id): "#" + channel.name
+            for channel in self.channel_mentions
+        }
+        transformations.update(
+            {
+                re.escape("<@%s>" % member.id): "@" + member.display_name
+                for member in self.mentions
+            }
+        )
+        transformations.update(
+            {
+                re.escape("<@!%s>" % member.id): "@" + member.display_name
+                for member in self.mentions
+            }
+        )
+        if self.guild is not None:
+            transformations.update(
+                {
+                    re.escape("<@&%s>" % role.id): "@" + role.name
+                    for role in self.role_mentions
+                }
+            )
+
+        def repl(obj):
+            return transformations.get(re.escape(obj.group(0)), "")
+
+        pattern = re.compile("|".join(transformations.keys()))
+        result = pattern.sub(repl, self.content)
+        return re.sub(r"@(everyone|here|[!&]?[0-9]{17,20})", "@\u200b\\1", result)
+
+
+# StackedBot.clean_message before message_cleaner, kept as the baseline
+def legacy_clean_message(message):
+    msg = message.clean_content
+    try:
+        if msg.startswith(">"):
+            msg = msg.split("\n")[1]
+        if msg.startswith("@"):
+            found_user_mention = False
+            for member in message.mentions:
+                member_name = member.nick if member.nick is not None else member.name
+                if msg.startswith(f"@{member_name}"):
+                    msg = msg.replace(f"@{member_name}", "", 1)
+                    found_user_mention = True
+            if not found_user_mention:
+                msg = msg.split(" ", 1)
+                if len(msg) != 2:
+                    return None
+                msg = msg[1]
+        if "@" in msg:
+            msg = msg.replace("@", "")
+    except:
+        return None
+    return msg
+
+
+def snowflake(rng):
+    return rng.randrange(10 ** 17, 10 ** 18)
+
+
+def build_guild(count, rng):
+    members = [Member(snowflake(rng), "Stacked")]
+    for i in range(count):
+        name = f"{rng.choice(['Dark', 'Holy', 'Sir', 'xX', 'Lil'])}{rng.choice(WORDS)}{i}"
+        nick = f"{rng.choice(WORDS).capitalize()} {i}" if rng.random() < 0.3 else None
+        members.append(Member(snowflake(rng), name, nick))
+    roles = [Role(snowflake(rng), name) for name in ["EU", "NA", "Officers"]]
+    channels = [Channel(snowflake(rng), name) for name in ["public-eu", "lobby"]]
+    return Guild(members, roles, channels)
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+
+
+# Chat-like traffic: plain chatter, mentions, role pings and quote replies
+def build_messages(count, guild, rng):
+    members = list(guild.members.values())
+    roles = list(guild.roles.values())
+    channels = list(guild.channels.values())
+    messages = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.55:
+            messages.append(Message(sentence(rng), guild))
+        elif roll < 0.8:
+            mentioned = rng.sample(members, rng.randint(1, 2))
+            text = f"<@!{mentioned[0].id}> {sentence(rng)}"
+            if len(mentioned) > 1:
+                text += f" <@{mentioned[1].id}>"
+            messages.append(Message(text, guild, mentioned))
+        elif roll < 0.85:
+            role = rng.choice(roles)
+            messages.append(Message(f"<@&{role.id}> {sentence(rng)}", guild, role_mentions=[role]))
+        elif roll < 0.9:
+            channel = rng.choice(channels)
+            messages.append(
+                Message(f"{sentence(rng)} in <#{channel.id}>", guild, channel_mentions=[channel])
+            )
+        else:
+            member = rng.choice(members)
+            messages.append(
+                Message(f"> {sentence(rng)}\n<@{member.id}> {sentence(rng)}", guild, [member])
+            )
+    return messages
+
+
+def measure(func, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            func(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    guild = build_guild(args.members, rng)
+    messages = build_messages(args.messages, guild, rng)
+
+    legacy = measure(legacy_clean_message, messages, args.repeat)
+    current = measure(clean_message, messages, args.repeat)
+    differences = sum(
+        1 for message in messages if legacy_clean_message(message) != clean_message(message)
+    )
+
+    print(f"messages:     {len(messages)} in a guild of {len(guild.members)}")
+    print(f"legacy:       {legacy * 1e9:.0f}ns/message")
+    print(f"clean:        {current * 1e9:.0f}ns/message")
+    print(f"speedup:      {legacy / current:.1f}x")
+    print(f"differences:  {differences}")
+
+
+if __name__ == "__main__":
+    main()
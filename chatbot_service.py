@@ -0,0 +1,266 @@
+"""
+Chatbot service
+
+Runs the chatterbot/spaCy stack in its own process, so it neither bloats the
+Discord gateway process nor fights it for the GIL. The bot talks to it over
+a Unix socket, one JSON object per line:
+
+    {"op": "train", "lines": ["...", "..."]}  -> {"ok": true}
+    {"op": "respond", "text": "..."}          -> {"ok": true, "text": "..."}
+    {"op": "ping"}                            -> {"ok": true}
+
+Start one or more workers, each on its own socket, and list them in
+CHATBOT_SOCKETS for the bot:
+
+    python chatbot_service.py --socket chatbot-1.sock
+    python chatbot_service.py --socket chatbot-2.sock
+
+Workers can be restarted at any time, the bot reconnects on its next request.
+The bot trains and asks for responses over separate connections, and a worker
+trains one line at a time, so a response waits for at most one line of
+training.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Default socket of the service
+CHATBOT_SOCKET = "chatbot.sock"
+
+# Training lines are sent in batches of this size, or after this many seconds
+TRAIN_BATCH_SIZE = 50
+TRAIN_BATCH_DELAY = 5.0
+
+# Training lines kept while no worker is reachable
+TRAIN_MAX_PENDING = 1000
+
+# Seconds to wait for a worker to answer
+REQUEST_TIMEOUT = 10.0
+
+# Seconds to wait for a worker to train a whole batch
+TRAIN_TIMEOUT = 300.0
+
+
+class ChatbotService:
+    """Serves chatterbot training and responses on a Unix socket"""
+
+    def __init__(self, database_uri="sqlite:///database.db"):
+        # Imported here, so the bot process never loads chatterbot and spaCy
+        from chatterbot import ChatBot, languages
+        from chatterbot.trainers import ListTrainer
+
+        # Fixing spacy at runtime, it is required to previously call 'python -m spacy download en'
+        languages.ENG.ISO_639_1 = "en_core_web_sm"
+
+        self.bot = ChatBot(
+            "@Stacked",
+            storage_adapter="chatterbot.storage.SQLStorageAdapter",
+            logic_adapters=[
+                "chatterbot.logic.MathematicalEvaluation",
+                # 'chatterbot.logic.TimeLogicAdapter',
+                "chatterbot.logic.BestMatch",
+            ],
+            database_uri=database_uri,
+        )
+        self.trainer = ListTrainer(self.bot, show_training_progress=False)
+
+        # chatterbot is not thread safe, everything runs on this one thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def train(self, line):
+        self.trainer.train([line])
+
+    def respond(self, text):
+        return f"{self.bot.get_response(text)}"
+
+    async def handle(self, request):
+        loop = asyncio.get_event_loop()
+        op = request.get("op")
+        if op == "train":
+            # Line by line, so responses queued meanwhile get their turn
+            for line in request["lines"]:
+                await loop.run_in_executor(self.executor, self.train, line)
+            return {"ok": True}
+        if op == "respond":
+            text = await loop.run_in_executor(self.executor, self.respond, request["text"])
+            return {"ok": True, "text": text}
+        if op == "ping":
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown op {op}"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.handle(json.loads(line))
+                except Exception as e:
+                    print(f"Error handling {line!r}: {e}")
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle_connection, path)
+        print(f"Chatbot service listening on {path}")
+        async with server:
+            await server.serve_forever()
+
+
+class ChatbotWorker:
+    """Connection to one chatbot service, one request at a time"""
+
+    def __init__(self, path, timeout=REQUEST_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+        self.reused = False
+
+    async def request(self, payload):
+        async with self.lock:
+            try:
+                line = await self.send(payload)
+            except ConnectionError:
+                # A connection from before a worker restart only shows it is dead
+                # now, nothing was answered on it, so try once on a fresh one
+                if not self.reused:
+                    raise
+                line = await self.send(payload)
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error"))
+        return reply
+
+    # Send one request and read the reply line
+    async def send(self, payload):
+        self.reused = self.writer is not None
+        try:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_unix_connection(
+                    self.path
+                )
+            self.writer.write(json.dumps(payload).encode() + b"\n")
+            await self.writer.drain()
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionError("chatbot service closed the connection")
+            return line
+        except (OSError, asyncio.TimeoutError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class ChatbotClient:
+    """
+    Talks to the chatbot services from the bot
+    Training lines are batched and go to the first reachable worker, response
+    requests are spread round robin over all of them. Each worker gets two
+    connections, so responses never queue behind a training batch.
+    """
+
+    def __init__(
+        self,
+        paths,
+        batch_size=TRAIN_BATCH_SIZE,
+        batch_delay=TRAIN_BATCH_DELAY,
+        metrics=None,
+    ):
+        self.workers = [ChatbotWorker(path) for path in paths]
+        self.trainers = [ChatbotWorker(path, TRAIN_TIMEOUT) for path in paths]
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.metrics = metrics
+        self.pending = []
+        self.flusher = None
+        self.next_worker = 0
+
+    def timer(self, name):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.timer("service", name)
+
+    # Queue a line for training
+    def train(self, line):
+        self.pending.append(line)
+        if len(self.pending) > TRAIN_MAX_PENDING:
+            self.pending = self.pending[-TRAIN_MAX_PENDING:]
+
+        if len(self.pending) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_delay)
+        await self.flush()
+
+    # Send all queued training lines
+    async def flush(self):
+        if not self.pending:
+            return
+        lines = self.pending
+        self.pending = []
+        with self.timer("chatterbot_train"):
+            for worker in self.trainers:
+                try:
+                    await worker.request({"op": "train", "lines": lines})
+                    return
+                except (asyncio.TimeoutError, RuntimeError) as e:
+                    # The worker got them and may well still be training, sending
+                    # them again would train them twice
+                    print(f"Chatbot worker {worker.path} failed to train: {e!r}")
+                    return
+                except OSError as e:
+                    print(f"Chatbot worker {worker.path} failed to train: {e!r}")
+        # Nobody took them, keep them for the next flush
+        self.pending = (lines + self.pending)[-TRAIN_MAX_PENDING:]
+
+    # Response to text, None when no worker could answer
+    async def respond(self, text):
+        with self.timer("chatterbot_response"):
+            for _ in range(len(self.workers)):
+                worker = self.workers[self.next_worker]
+                self.next_worker = (self.next_worker + 1) % len(self.workers)
+                try:
+                    reply = await worker.request({"op": "respond", "text": text})
+                    return reply["text"]
+                except (OSError, asyncio.TimeoutError, RuntimeError) as e:
+                    print(f"Chatbot worker {worker.path} failed to respond: {e}")
+        return None
+
+    async def close(self):
+        await self.flush()
+        for worker in self.workers + self.trainers:
+            worker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="StackedBot chatbot service")
+    parser.add_argument("--socket", default=CHATBOT_SOCKET)
+    parser.add_argument("--database", default="sqlite:///database.db")
+    args = parser.parse_args()
+
+    service = ChatbotService(args.database)
+    asyncio.run(service.serve(args.socket))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# Keys are cut in one more piece than the most typos tolerated, so one of the
+# pieces survives intact
+BLOCKS = 3
+
+
+class TrieNode:
+    __slots__ = ("children", "terminal", "count")
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = False
+        # Number of keys at or below this node
+        self.count = 0
+
+
+# Edit distance between a and b counting a swap of neighbours as one typo,
+# or None when it is over limit
+def bounded_edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return None
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        best = i
+        for j, cb in enumerate(b, 1):
+            cost = previous[j - 1] + (ca != cb)
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if (
+                before is not None
+                and j > 1
+                and ca == b[j - 2]
+                and a[i - 2] == cb
+                and before[j - 2] + 1 < cost
+            ):
+                cost = before[j - 2] + 1
+            current.append(cost)
+            if cost < best:
+                best = cost
+        if best > limit:
+            return None
+        before, previous = previous, current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+# The key and everything up to depth deleted characters away,
+# deletions("kvk") -> {"kvk", "vk", "kk", "kv"}
+def deletions(key, depth=1):
+    found = {key}
+    edge = found
+    for _ in range(depth):
+        edge = {word[:i] + word[i + 1 :] for word in edge for i in range(len(word))}
+        found |= edge
+    return found
+
+
+# Start and end of the BLOCKS pieces a key of length n is cut into, shortest first
+def blocks(n):
+    size, longer = divmod(n, BLOCKS)
+    bounds = []
+    start = 0
+    for i in range(BLOCKS):
+        end = start + size + (i >= BLOCKS - longer)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+# Typos tolerated for a key of this length
+def max_typos(key):
+    return 1 if len(key) <= 4 else 2
+
+
+# Add or remove key under entry, a single key or a set of keys when several share it
+def add_entry(index, entry, key):
+    keys = index.get(entry)
+    if keys is None:
+        index[entry] = key
+    elif isinstance(keys, str):
+        index[entry] = {keys, key}
+    else:
+        keys.add(key)
+
+
+def remove_entry(index, entry, key):
+    keys = index[entry]
+    if isinstance(keys, str):
+        del index[entry]
+        return
+    keys.discard(key)
+    if len(keys) == 1:
+        index[entry] = keys.pop()
+
+
+class GlossaryIndex:
+    """
+    In-memory index over the !whatis keywords
+    A trie answers prefix listings. Typo-tolerant lookups shortlist keys from
+    two small indexes and check each one with bounded_edit_distance:
+    - every key one character deletion away, matched against the lookup's
+      deletions as deep as its typos, finds one typo, and two when the key
+      needs at most one of the deletions (an extra character and a swap, say)
+    - each key cut into BLOCKS pieces, matched against the lookup's characters
+      around the same position, finds two typos that do need two deletions
+      from the key (two wrong characters, say): they spoil at most two pieces
+    """
+
+    def __init__(self, keys=()):
+        self.root = TrieNode()
+        # deletion -> key, or set of keys when several share it
+        self.deletions = {}
+        # (length, piece number) -> {piece -> key, or set of keys}
+        self.blocks = {}
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self.root.count
+
+    def __contains__(self, key):
+        node = self.find(key)
+        return node is not None and node.terminal
+
+    def find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def add(self, key):
+        if key in self:
+            return
+        node = self.root
+        node.count += 1
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = TrieNode()
+            node = child
+            node.count += 1
+        node.terminal = True
+
+        for deletion in deletions(key):
+            add_entry(self.deletions, deletion, key)
+        if len(key) >= BLOCKS:
+            for i, (start, end) in enumerate(blocks(len(key))):
+                add_entry(self.blocks.setdefault((len(key), i), {}), key[start:end], key)
+
+    def remove(self, key):
+        if key not in self:
+            return
+        node = self.root
+        node.count -= 1
+        for char in key:
+            child = node.children[char]
+            child.count -= 1
+            if child.count == 0:
+                # Nothing else below, drop the whole branch
+                del node.children[char]
+                break
+            node = child
+        else:
+            node.terminal = False
+
+        for deletion in deletions(key):
+            remove_entry(self.deletions, deletion, key)
+        if len(key) >= BLOCKS:
+            for i, (start, end) in enumerate(blocks(len(key))):
+                pieces = self.blocks[(len(key), i)]
+                remove_entry(pieces, key[start:end], key)
+                if not pieces:
+                    del self.blocks[(len(key), i)]
+
+    # Keys starting with prefix in alphabetical order, and how many there are
+    def complete(self, prefix, limit=20):
+        start = self.find(prefix)
+        if start is None:
+            return [], 0
+
+        keys = []
+        stack = [(start, prefix)]
+        while stack and len(keys) < limit:
+            node, key = stack.pop()
+            if node.terminal:
+                keys.append(key)
+            for char in sorted(node.children, reverse=True):
+                stack.append((node.children[char], key + char))
+        return keys, start.count
+
+    # Keys within a few typos of key, closest first
+    def similar(self, key, limit=5):
+        typos = max_typos(key)
+        candidates = set()
+
+        def collect(keys):
+            if isinstance(keys, str):
+                candidates.add(keys)
+            elif keys is not None:
+                candidates.update(keys)
+
+        for deletion in deletions(key, typos):
+            collect(self.deletions.get(deletion))
+
+        # The deletions miss two typos only when both cost a deletion from the
+        # key, which takes a key at least as long as the lookup
+        if typos == BLOCKS - 1:
+            m = len(key)
+            # A swap can spoil two pieces, undo it and look for the other typo
+            for i in range(m - 1):
+                if key[i] != key[i + 1]:
+                    swapped = key[:i] + key[i + 1] + key[i] + key[i + 2 :]
+                    for deletion in deletions(swapped):
+                        collect(self.deletions.get(deletion))
+            # A piece of a key of length n that no typo touched sits in the
+            # lookup shifted by at most the typos before it, and by the length
+            # difference give or take the typos after it
+            for n in range(max(BLOCKS, m), m + typos + 1):
+                shift = m - n
+                for i, (start, end) in enumerate(blocks(n)):
+                    pieces = self.blocks.get((n, i))
+                    if pieces is None:
+                        continue
+                    after = typos - i
+                    lowest = max(start - i, start + shift - after, 0)
+                    highest = min(start + i, start + shift + after, m - (end - start))
+                    for position in range(lowest, highest + 1):
+                        collect(pieces.get(key[position : position + end - start]))
+        candidates.discard(key)
+
+        # Each typo brings in at most one character the lookup doesn't have
+        chars = set(key)
+        matches = []
+        for candidate in candidates:
+            if sum(char not in chars for char in candidate) > typos:
+                continue
+            distance = bounded_edit_distance(key, candidate, typos)
+            if distance is not None:
+                matches.append((distance, candidate))
+        return [candidate for distance, candidate in sorted(matches)[:limit]]
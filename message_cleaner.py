@@ -0,0 +1,60 @@
+import re
+
+# Raw Discord mentions: <@id> and <@!id> members, <@&id> roles, <#id> channels
+MENTION = re.compile(r"<(@!?|@&|#)(\d+)>")
+
+# Member mentions the message opens with
+LEADING_MENTIONS = re.compile(r"(?:<@!?\d+>)+")
+
+
+# Name Discord shows for a mention, without the @
+def mention_name(message, kind, id):
+    guild = message.guild
+    if kind == "#":
+        channel = guild.get_channel(id) if guild is not None else None
+        return f"#{channel.name}" if channel is not None else ""
+    if kind == "@&":
+        role = guild.get_role(id) if guild is not None else None
+        return role.name if role is not None else ""
+    member = guild.get_member(id) if guild is not None else None
+    if member is None:
+        member = next((user for user in message.mentions if user.id == id), None)
+    return member.display_name if member is not None else ""
+
+
+def clean_message(message):
+    """
+    Text of message for the chatbot, or None when there is nothing left
+    Works on the raw content in one pass: keeps the reply to a quote, drops
+    the mention or word the message opens with, shows the remaining mentions
+    by name and removes any @.
+    """
+    msg = message.content
+
+    # Reply to a quote, keep the line after it
+    if msg.startswith(">"):
+        start = msg.find("\n") + 1
+        if start == 0:
+            return None
+        end = msg.find("\n", start)
+        msg = msg[start:] if end == -1 else msg[start:end]
+
+    if msg.startswith("<@") and not msg.startswith("<@&"):
+        match = LEADING_MENTIONS.match(msg)
+        if match is not None:
+            msg = msg[match.end() :]
+    elif msg.startswith("@") or msg.startswith("<@&"):
+        # A role or something that only looks like a mention, skip the word
+        space = msg.find(" ")
+        if space == -1:
+            return None
+        msg = msg[space + 1 :]
+
+    if "<" in msg:
+        msg = MENTION.sub(
+            lambda match: mention_name(message, match.group(1), int(match.group(2))),
+            msg,
+        )
+    if "@" in msg:
+        msg = msg.replace("@", "")
+    return msg
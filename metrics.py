@@ -0,0 +1,294 @@
+import asyncio
+import functools
+import sys
+import threading
+import time
+import traceback
+
+# Histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text for the Prometheus endpoint, per metric family
+FAMILIES = {
+    "handler": "Event handler latency",
+    "command": "Command latency",
+    "service": "External service call latency",
+    "loop": "Event loop scheduling lag",
+}
+
+
+class Histogram:
+    """Fixed bucket latency histogram"""
+
+    __slots__ = ("counts", "count", "total", "max", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Upper bound of the bucket holding the given quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.histogram.errors += 1
+        return False
+
+
+class Metrics:
+    """
+    Latency histograms for handlers, commands and external services
+    Everything is keyed by (family, name), e.g. ("service", "wikipedia").
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        # Extra gauges, name -> callable returning a number
+        self.gauges = {}
+
+    def histogram(self, family, name):
+        key = (family, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    # Context manager timing the enclosed block
+    def timer(self, family, name):
+        return _Timer(self.histogram(family, name))
+
+    def observe(self, family, name, seconds):
+        self.histogram(family, name).observe(seconds)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    # Human readable summary for !stats, one section per family and one for
+    # the gauges, each cut down to at most limit characters
+    def summary(self, limit=None):
+        sections = []
+        for family, help_text in FAMILIES.items():
+            rows = sorted(
+                (name, h) for (f, name), h in self.histograms.items() if f == family
+            )
+            if not rows:
+                continue
+            lines = [
+                f"  {name:<20} {h.count:>6} {h.errors:>4} "
+                f"{h.quantile(0.5) * 1000:>7.1f} {h.quantile(0.99) * 1000:>7.1f} "
+                f"{h.max * 1000:>7.1f}"
+                for name, h in rows
+            ]
+            header = f"{help_text}: calls / errors / p50 / p99 / max (ms)"
+            sections.append(_fit_section(header, lines, limit))
+        if self.gauges:
+            lines = [
+                f"{name}: {_format_number(func())}"
+                for name, func in sorted(self.gauges.items())
+            ]
+            sections.append(_fit_section("Gauges", lines, limit))
+        return sections
+
+    # Prometheus text exposition format
+    def render_prometheus(self):
+        lines = []
+        for family, help_text in FAMILIES.items():
+            rows = sorted(
+                (name, h) for (f, name), h in self.histograms.items() if f == family
+            )
+            if not rows:
+                continue
+            metric = f"stackedbot_{family}_seconds"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in rows:
+                label = f'{family}="{_escape_label(name)}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{label}}} {h.total}")
+                lines.append(f"{metric}_count{{{label}}} {h.count}")
+            errors = f"stackedbot_{family}_errors_total"
+            lines.append(f"# TYPE {errors} counter")
+            for name, h in rows:
+                lines.append(f'{errors}{{{family}="{_escape_label(name)}"}} {h.errors}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE stackedbot_{name} gauge")
+            lines.append(f"stackedbot_{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    # HTTP endpoint serving render_prometheus, bound to localhost by default
+    # Returns None when the port can't be bound, metrics are not worth failing for
+    async def serve(self, port, host="127.0.0.1"):
+        try:
+            server = await asyncio.start_server(self._handle_scrape, host, port)
+        except OSError as e:
+            print(f"Could not serve metrics on {host}:{port}: {e}")
+            return None
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    async def _handle_scrape(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request.split(b" ")[1:2] == [b"/metrics"]:
+                status = "200 OK"
+                body = self.render_prometheus().encode()
+            else:
+                status = "404 Not Found"
+                body = b"not found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# Decorator timing a coroutine method into self.metrics
+def timed(family, name=None):
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(family, label):
+                return await func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Header and lines joined, dropping lines from the end to stay within limit
+def _fit_section(header, lines, limit):
+    text = "\n".join([header] + lines)
+    if limit is None or len(text) <= limit:
+        return text
+    kept = []
+    size = len(header)
+    for i, line in enumerate(lines):
+        more = f"  ... {len(lines) - i} more"
+        if size + 1 + len(line) + 1 + len(more) > limit:
+            return "\n".join([header] + kept + [more])
+        kept.append(line)
+        size += 1 + len(line)
+    return "\n".join([header] + kept)
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return f"{value}"
+
+
+class LoopLagMonitor:
+    """
+    Detects blocking of the event loop
+    A task on the loop ticks a heartbeat, a watchdog thread checks it and logs
+    the loop thread's stack when the loop has been stuck for over threshold
+    seconds.
+    """
+
+    def __init__(self, metrics, threshold=0.25, interval=0.05):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.loop_thread = None
+        self.task = None
+        self.running = False
+
+        metrics.gauge("loop_stalls_total", lambda: self.stalls)
+        metrics.gauge("loop_max_lag_seconds", lambda: self.max_lag)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.ensure_future(self._tick())
+        threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _tick(self):
+        while self.running:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - before - self.interval
+            self.metrics.observe("loop", "lag", max(lag, 0.0))
+            if lag > self.max_lag:
+                self.max_lag = lag
+            self.heartbeat = now
+
+    def _watch(self):
+        reported = None
+        while self.running:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            # Report each stall once
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            print(f"Event loop blocked for over {blocked:.3f}s in:\n{stack}")
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import deque
+
+# char limit in Discord when sending a message
+DISCORD_CHAR_LIMIT = 2000
+
+# Number of send latencies kept for the stats
+LATENCY_WINDOW = 256
+
+
+# Split text into pieces no longer than limit, preferring line breaks.
+# Blank pieces are dropped, Discord refuses to send them
+def split_message(text, limit=DISCORD_CHAR_LIMIT):
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = skip = limit
+        else:
+            # Drop the line break or space we cut at
+            skip = cut + 1
+        chunk = text[:cut]
+        text = text[skip:]
+        if chunk.strip():
+            chunks.append(chunk)
+    if text.strip():
+        chunks.append(text)
+    return chunks
+
+
+# Merge consecutive short messages into as few sends as possible
+def coalesce(messages, limit=DISCORD_CHAR_LIMIT):
+    batches = []
+    current = None
+    for message in messages:
+        for chunk in split_message(message, limit):
+            if current is not None and len(current) + 1 + len(chunk) <= limit:
+                current = f"{current}\n{chunk}"
+            else:
+                if current is not None:
+                    batches.append(current)
+                current = chunk
+    if current is not None:
+        batches.append(current)
+    return batches
+
+
+class OutboundQueue:
+    """
+    Per-channel outbound message queue
+    A message to an idle channel goes out right away. Messages queued while a
+    send to the channel is in flight are merged into as few sends as possible
+    and long messages are split at DISCORD_CHAR_LIMIT, so we stay under
+    Discord's per-channel rate limits.
+    """
+
+    def __init__(self, limit=DISCORD_CHAR_LIMIT):
+        self.limit = limit
+
+        # messageable -> pending messages (text, enqueue time)
+        self.pending = {}
+        self.workers = {}
+
+        # Stats
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.peak_depth = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    # Queue a message for a channel, user or member
+    def send(self, channel, content):
+        content = f"{content}"
+        if not content.strip():
+            return
+
+        queue = self.pending.setdefault(channel, deque())
+        queue.append((content, time.perf_counter()))
+        self.enqueued += 1
+        self.peak_depth = max(self.peak_depth, len(queue))
+
+        worker = self.workers.get(channel)
+        if worker is None or worker.done():
+            self.workers[channel] = asyncio.ensure_future(self.drain_channel(channel))
+
+    # Flush everything queued for one channel
+    async def drain_channel(self, channel):
+        queue = self.pending[channel]
+        try:
+            # Whatever queued up during the last send goes out together
+            while queue:
+                messages = [text for text, _ in queue]
+                oldest = queue[0][1]
+                queue.clear()
+
+                for batch in coalesce(messages, self.limit):
+                    # A failed send must not take the rest of the burst with it
+                    try:
+                        await channel.send(batch)
+                        self.sent += 1
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"Failed to send to {channel}: {e!r}")
+                self.latencies.append(time.perf_counter() - oldest)
+        finally:
+            self.pending.pop(channel, None)
+            self.workers.pop(channel, None)
+
+    # Wait until all queued messages have been sent
+    async def join(self):
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
+
+    # Total number of messages waiting to be sent
+    def depth(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        else:
+            p50 = p99 = 0.0
+        return {
+            "depth": self.depth(),
+            "peak_depth": self.peak_depth,
+            "channels": len(self.pending),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "latency_p50": p50,
+            "latency_p99": p99,
+        }
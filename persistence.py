@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import dbm
+import os
+import pickle
+import shelve
+import tempfile
+import time
+from collections.abc import MutableMapping
+
+# Seconds between two flushes of the bot state
+PERSIST_INTERVAL = 30.0
+
+
+class PersistentDict(MutableMapping):
+    """
+    Dict kept in memory and saved as an atomic snapshot file
+    Assignments and deletions mark it dirty; call touch() after changing a
+    value in place. Starting up loads the snapshot, or the shelve the data
+    used to live in when there is no snapshot yet.
+    """
+
+    def __init__(self, path, copy_value=None):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        # Copies a value for the snapshot, needed for values changed in place
+        self.copy_value = copy_value
+        self.version = 0
+        self.saved_version = 0
+        self.data = self.load()
+
+    def load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as fp:
+                return pickle.load(fp)
+        if dbm.whichdb(self.path):
+            with shelve.open(self.path, flag="r") as shelf:
+                data = dict(shelf)
+            # Get it into a snapshot on the next flush
+            self.version += 1
+            return data
+        return {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.version += 1
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.version += 1
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def touch(self):
+        self.version += 1
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    # Consistent copy of the data, taken on the event loop
+    def snapshot(self):
+        if self.copy_value is None:
+            return dict(self.data)
+        return {key: self.copy_value(value) for key, value in self.data.items()}
+
+    # Write data to the snapshot file atomically, returns the bytes written
+    def write(self, data):
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        # A temp file of its own, two writes never share one
+        fd, temp_path = tempfile.mkstemp(
+            prefix=f"{os.path.basename(self.snapshot_path)}.", suffix=".tmp", dir=directory
+        )
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                fp.flush()
+                os.fsync(fp.fileno())
+                size = fp.tell()
+            os.replace(temp_path, self.snapshot_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+        # Make the rename itself durable
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return size
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return size
+
+
+class Persister:
+    """
+    Flushes PersistentDicts every interval seconds
+    Only the copy runs on the event loop, pickling and writing happen on an
+    executor thread.
+    """
+
+    def __init__(self, stores, interval=PERSIST_INTERVAL, metrics=None):
+        self.stores = stores
+        self.interval = interval
+        self.metrics = metrics
+        self.task = None
+        # Write running on the executor, outlives a cancelled flush
+        self.writing = None
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8, stop() would never return
+                raise
+            except Exception as e:
+                print(f"Failed to flush state: {e}")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        # Let a write the cancelled flush started land before the final one
+        if self.writing is not None:
+            try:
+                await self.writing
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            for name, store in self.stores.items():
+                if not store.dirty:
+                    continue
+                try:
+                    await self.flush_store(name, store)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Failed to flush {name}: {e!r}")
+
+    async def flush_store(self, name, store):
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        version = store.version
+        data = store.snapshot()
+        paused = time.perf_counter() - start
+
+        self.writing = loop.run_in_executor(None, store.write, data)
+        size = await asyncio.shield(self.writing)
+        self.writing = None
+        store.saved_version = version
+        elapsed = time.perf_counter() - start
+
+        if self.metrics is not None:
+            self.metrics.observe("service", f"flush_{name}", elapsed)
+        print(
+            f"Flushed {name}: {len(data)} entries, {size} bytes in "
+            f"{elapsed * 1000:.1f}ms ({paused * 1000:.1f}ms on the event loop)"
+        )
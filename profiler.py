@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Seconds between two samples
+SAMPLE_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads for a while and writes them out in
+    collapsed stack format (one "root;...;leaf count" line per stack), ready
+    for flamegraph.pl or speedscope.
+    Nothing runs until a profile is requested.
+    """
+
+    def __init__(self, directory="profiles", interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+
+    # Reserve the profiler for a run, False when one is already running
+    def claim(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            return True
+
+    # Profile for the given number of seconds, blocking. Returns the file path
+    def run(self, seconds, claimed=False):
+        if not claimed and not self.claim():
+            raise RuntimeError("A profile is already running")
+        try:
+            stacks, samples = self.sample(seconds)
+            return self.write(stacks, samples, seconds)
+        finally:
+            self.running = False
+
+    def sample(self, seconds):
+        me = threading.get_ident()
+        labels = {}
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (
+                            f"{code.co_name} "
+                            f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                        )
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+    def write(self, stacks, samples, seconds):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, f"stackedbot-{stamp}.folded")
+        with open(path, "w") as fp:
+            for stack, count in stacks.most_common():
+                fp.write(f"{stack} {count}\n")
+        print(f"Wrote {samples} samples over {seconds}s to {path}")
+        return path
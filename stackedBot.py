@@ -1,7 +1,8 @@
+import asyncio
 import json
 import os
 import pathlib
-import shelve
+import signal
 
 # Datetime calculations
 from datetime import datetime, timedelta, timezone
@@ -17,13 +18,30 @@ import requests
 # Wikipedia lookups
 import wikipedia
 
-# Chat bot
-from chatterbot import ChatBot, languages
-from chatterbot.trainers import ListTrainer
+# Chat bot, served by chatbot_service.py
+from chatbot_service import CHATBOT_SOCKET, ChatbotClient
 
 # Load environment
 from dotenv import load_dotenv
 
+# Fast !whatis lookups
+from glossary import GlossaryIndex
+
+# Quote and mention stripping for the chatbot
+from message_cleaner import clean_message
+
+# Instrumentation
+from metrics import LoopLagMonitor, Metrics, timed
+
+# Rate limit friendly sending
+from outbound import DISCORD_CHAR_LIMIT, OutboundQueue
+
+# Snapshots of the bot state
+from persistence import PERSIST_INTERVAL, PersistentDict, Persister
+
+# On demand profiling
+from profiler import SamplingProfiler
+
 # Translation support
 from googletrans import Translator
 
@@ -38,14 +56,51 @@ class Region(Enum):
     EU = 1
     NA = 2
 
-load_dotenv()
+# Regions, the guild channel and role they notify and their ingame timezone
+REGION_CONFIGS = {
+    Region.EU: {
+        "channelId": "public-eu",
+        "role": "eu",
+        "tz": 1,
+    },
+    Region.NA: {
+        "channelId": "public-na",
+        "role": "na",
+        "tz": -6,
+    },
+}
 
-# Fixing spacy at runtime, it is required to previously call 'python -m spacy download en'
-languages.ENG.ISO_639_1 = "en_core_web_sm"
+load_dotenv()
 
 URBAN_DICTIONARY_API_KEY = os.getenv("URBAN_DICTIONARY_API_KEY")
-# char limit in Discord when sending a message
-DISCORD_CHAR_LIMIT = 2000
+
+# Users allowed to run admin commands, besides server administrators
+ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split()]
+
+# Reminder subscribers from before multiple guilds, no guild owns them yet
+UNOWNED_REMINDERS = None
+
+# Default and maximum length of a profile in seconds
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "30"))
+PROFILE_MAX_SECONDS = 300
+
+# Commands, used to label command metrics
+COMMANDS = [
+    "help",
+    "events",
+    "event",
+    "kvkcalc",
+    "addis",
+    "whatis",
+    "remis",
+    "lookup",
+    "urban",
+    "inspireme",
+    "remindme",
+    "role",
+    "stats",
+    "profile",
+]
 
 # Read codec file for language codes
 def readCodeFile(filename):
@@ -60,6 +115,74 @@ def readCodeFile(filename):
         return data
 
 
+# Read the per guild role and channel ids, keyed by guild id, e.g.
+# {"<guild id>": {"eu_role": 1, "na_role": 2, "public_eu_channel": 3,
+#                 "public_na_channel": 4, "lobby_channel": 5}}
+def readGuildConfigFile(filename):
+    with open(filename) as fp:
+        return {
+            int(guild_id): {key: int(value) for key, value in config.items()}
+            for guild_id, config in json.load(fp).items()
+        }
+
+
+# Single guild configuration from the environment, if there is one
+def legacyGuildConfig():
+    keys = ["EU_ROLE", "NA_ROLE", "PUBLIC_EU_CHANNEL", "PUBLIC_NA_CHANNEL", "LOBBY_CHANNEL"]
+    if not all(os.getenv(key) for key in keys):
+        return None
+    return {key.lower(): int(os.getenv(key)) for key in keys}
+
+
+# Copy of a reminder entry for a snapshot, {guild id: set of user ids}
+def copy_subscribers(subscribers):
+    if isinstance(subscribers, list):
+        # Not migrated yet
+        return list(subscribers)
+    return {guild_id: set(ids) for guild_id, ids in subscribers.items()}
+
+
+class GuildState:
+    """Roles and channels the bot uses in one guild"""
+
+    def __init__(self, guild, config):
+        self.guild = guild
+
+        # Roles
+        self.com_roles = {
+            "eu": guild.get_role(config["eu_role"]),
+            "na": guild.get_role(config["na_role"]),
+            "everyone": guild.default_role,
+        }
+
+        # Channels
+        self.com_channels = {
+            "public-eu": guild.get_channel(config["public_eu_channel"]),
+            "public-na": guild.get_channel(config["public_na_channel"]),
+            "lobby": guild.get_channel(config["lobby_channel"]),
+        }
+
+        # Regions
+        self.region_configs = {
+            region: {
+                "channelId": region_config["channelId"],
+                "tz": region_config["tz"],
+                "role": self.com_roles[region_config["role"]],
+            }
+            for region, region_config in REGION_CONFIGS.items()
+        }
+
+    # Names of the configured roles and channels that could not be found
+    def missing(self):
+        roles = [f"{role} role" for role, value in self.com_roles.items() if value is None]
+        channels = [
+            f"{channel} channel"
+            for channel, value in self.com_channels.items()
+            if value is None
+        ]
+        return roles + channels
+
+
 # Load plugin
 def loadPlugin(plugin_class):
     module_name = "plugins." + plugin_class
@@ -69,36 +192,58 @@ def loadPlugin(plugin_class):
     return cls()
 
 
-class StackedBot(discord.Client):
+class StackedBot(discord.AutoShardedClient):
     def __init__(self):
         # intents to send messages to users
         intents = discord.Intents.default()
         intents.members = True
         intents.reactions = True
-        super().__init__(intents=intents)
-
-        # Roles
-        self.com_roles = {
-            "eu": None,
-            "na": None,
-            "everyone": None,
-        }
+        shard_count = os.getenv("SHARD_COUNT")
+        super().__init__(
+            intents=intents,
+            shard_count=int(shard_count) if shard_count else None,
+        )
 
-        # Channels
-        self.com_channels = {
-            "public-eu": None,
-            "public-na": None,
-            "lobby": None,
-        }
+        # Guilds, their roles and channels, keyed by guild id
+        if os.getenv("GUILDCONFIGFILE"):
+            self.guild_configs = readGuildConfigFile(os.getenv("GUILDCONFIGFILE"))
+        else:
+            self.guild_configs = {}
+        self.guild_states = {}
+        # Guild configured through the environment, owns old reminder entries
+        self.legacy_guild_id = None
+
+        # Persistent state, saved to snapshot files by self.persister
+        self.whatis = PersistentDict(os.getenv("WHATISFILE"))
+        self.remind_me = PersistentDict(
+            os.getenv("REMINDERFILE"), copy_value=copy_subscribers
+        )
 
-        # Persistent state
-        self.whatis = shelve.open(os.getenv("WHATISFILE"), writeback=True)
-        self.remind_me = shelve.open(os.getenv("REMINDERFILE"), writeback=True)
+        # Prefix and typo-tolerant search over the whatis keywords
+        self.glossary = GlossaryIndex(self.whatis.keys())
 
         # Translator service
         self.translator = Translator()
         self.countryToLanguage = readCodeFile("country_languages.data.in")
 
+        # Scheduled notifications
+        self.cronTab = []
+
+        # Outbound messages, coalesced per channel
+        self.outbound = OutboundQueue()
+
+        # Instrumentation
+        self.metrics = Metrics()
+        self.metrics.gauge("outbound_queue_depth", self.outbound.depth)
+        self.metrics.gauge(
+            "outbound_send_latency_p99_seconds",
+            lambda: self.outbound.stats()["latency_p99"],
+        )
+        self.lag_monitor = LoopLagMonitor(
+            self.metrics, threshold=float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+        )
+        self.profiler = SamplingProfiler(os.getenv("PROFILE_DIR", "profiles"))
+
         self.initialized = False
 
         # Work in progress, split stuff out to plugins
@@ -110,95 +255,56 @@ class StackedBot(discord.Client):
         # credentials = service_account.Credentials.from_service_account_file('stackedBot.json', scopes=SCOPES)
         # self.sheetService = discovery.build('sheets', 'v4', credentials=credentials)
 
-        # Chatbot
-        self.bot = ChatBot(
-            "@Stacked",
-            storage_adapter="chatterbot.storage.SQLStorageAdapter",
-            logic_adapters=[
-                "chatterbot.logic.MathematicalEvaluation",
-                # 'chatterbot.logic.TimeLogicAdapter',
-                "chatterbot.logic.BestMatch",
-            ],
-            database_uri="sqlite:///database.db",
-        )
-        self.trainer = ListTrainer(self.bot, show_training_progress=False)
-        self.initialize_with_corpus = True
-
-    # Clean message string
-    def clean_message(self, message):
-        msg = message.clean_content
-        try:
-            if msg.startswith(">"):
-                msg = msg.split("\n")[1]
-            if msg.startswith("@"):
-                found_user_mention = False
-                for member in message.mentions:
-                    member_name = (
-                        member.nick if member.nick is not None else member.name
-                    )
-                    if msg.startswith(f"@{member_name}"):
-                        msg = msg.replace(f"@{member_name}", "", 1)
-                        found_user_mention = True
-                if not found_user_mention:
-                    msg = msg.split(" ", 1)
-                    if len(msg) != 2:
-                        return None
-                    msg = msg[1]
-            if "@" in msg:
-                msg = msg.replace("@", "")
-        except:
-            print(f"Error in parsing message: {message.clean_content}")
-            return None
-        return msg
+        # Chatbot, one or more chatbot_service.py workers
+        self.chatbot = ChatbotClient(
+            os.getenv("CHATBOT_SOCKETS", CHATBOT_SOCKET).split(), metrics=self.metrics
+        )
+
+        # Flushes the state every PERSIST_INTERVAL seconds. Chatbot training
+        # is flushed by the client itself, it can take minutes
+        self.persister = Persister(
+            {"whatis": self.whatis, "remind_me": self.remind_me},
+            interval=float(os.getenv("PERSIST_INTERVAL") or PERSIST_INTERVAL),
+            metrics=self.metrics,
+        )
 
     # Prepare the channels and stuff
     async def on_ready(self):
         if self.initialized:
             return
 
-        self.com_roles["eu"] = self.guilds[0].get_role(
-            int(os.getenv("EU_ROLE"))
-        )
-        self.com_roles["na"] = self.guilds[0].get_role(
-            int(os.getenv("NA_ROLE"))
-        )
-        self.com_roles["everyone"] = self.guilds[0].default_role
-
-        self.com_channels["public-eu"] = self.guilds[0].get_channel(
-            int(os.getenv("PUBLIC_EU_CHANNEL"))
-        )
-        self.com_channels["public-na"] = self.guilds[0].get_channel(
-            int(os.getenv("PUBLIC_NA_CHANNEL"))
-        )
-        self.com_channels["lobby"] = self.guilds[0].get_channel(
-            int(os.getenv("LOBBY_CHANNEL"))
-        )
-
-        for role in self.com_roles:
-            if self.com_roles[role] is None:
-                print(f"Could not find {role} role")
+        legacy = legacyGuildConfig()
+        if legacy is not None:
+            channel = self.get_channel(legacy["public_eu_channel"])
+            if channel is None:
+                print("Could not find public-eu channel")
                 quit()
+            self.legacy_guild_id = channel.guild.id
+            self.guild_configs.setdefault(self.legacy_guild_id, legacy)
+        self.migrate_reminders()
 
-        for channel in self.com_channels:
-            if self.com_channels[channel] is None:
-                print(f"Could not find {channel} channel")
-                quit()
+        for guild in self.guilds:
+            self.add_guild(guild)
 
-        # Regions
-        self.region_configs = {
-            Region.EU: {
-                "channelId": "public-eu",
-                "tz": 1,
-                "role": self.com_roles["eu"]
-            }, 
-            Region.NA: {
-                "channelId": "public-na",
-                "tz": -6,
-                "role": self.com_roles["na"]
-            },
-        }
+        print(
+            f"{self.user.name} has connected to {len(self.guilds)} guilds "
+            f"over {self.shard_count} shards, configured for {len(self.guild_states)}!"
+        )
 
-        print(f"{self.user.name} has connected to {self.guilds}!")
+        # Instrumentation
+        self.lag_monitor.start()
+        self.persister.start()
+        if os.getenv("METRICS_PORT"):
+            await self.metrics.serve(int(os.getenv("METRICS_PORT")))
+
+        # kill -USR1 <pid> profiles the bot for PROFILE_SECONDS
+        try:
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGUSR1,
+                lambda: asyncio.ensure_future(self.profile(PROFILE_SECONDS)),
+            )
+        except (AttributeError, NotImplementedError):
+            print("Profiling on SIGUSR1 is not supported on this platform")
 
         # Setup notifications
         self.setup_notifications(Region.EU)
@@ -206,23 +312,80 @@ class StackedBot(discord.Client):
 
         self.initialized = True
 
+    # Pick up roles and channels of a guild we have a configuration for
+    def add_guild(self, guild):
+        config = self.guild_configs.get(guild.id)
+        if config is None:
+            return
+
+        state = GuildState(guild, config)
+        missing = state.missing()
+        if missing:
+            print(f"Could not find {', '.join(missing)} in {guild.name}")
+            return
+        self.guild_states[guild.id] = state
+
+    # Reminders used to be a plain list of user ids for the only guild. They
+    # go to the legacy guild, or REMINDER_GUILD, and are kept under
+    # UNOWNED_REMINDERS until one of those is configured.
+    def migrate_reminders(self):
+        owner = self.legacy_guild_id
+        if owner is None and os.getenv("REMINDER_GUILD"):
+            owner = int(os.getenv("REMINDER_GUILD"))
+
+        for event_name in list(self.remind_me):
+            subscribers = self.remind_me[event_name]
+            if isinstance(subscribers, list):
+                subscribers = {UNOWNED_REMINDERS: set(subscribers)}
+                self.remind_me[event_name] = subscribers
+            if UNOWNED_REMINDERS not in subscribers:
+                continue
+            if owner is None:
+                print(
+                    f"Keeping {len(subscribers[UNOWNED_REMINDERS])} {event_name} "
+                    "reminders aside, set REMINDER_GUILD to the guild they belong to"
+                )
+                continue
+            subscribers.setdefault(owner, set()).update(
+                subscribers.pop(UNOWNED_REMINDERS)
+            )
+            self.remind_me.touch()
+
+    async def on_guild_available(self, guild):
+        if self.initialized:
+            self.add_guild(guild)
+
+    async def on_guild_join(self, guild):
+        self.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.guild_states.pop(guild.id, None)
+
+    # Send what is queued, save the state and hand pending chatbot training
+    # over before shutting down
+    async def close(self):
+        try:
+            self.lag_monitor.stop()
+            await self.outbound.join()
+            await self.persister.stop()
+            await self.chatbot.close()
+        finally:
+            await super().close()
+
     # The actual ingame time!
     def ingame_time(self, region):
-        return datetime.now(timezone.utc) + timedelta(hours=self.region_configs[region]["tz"])
+        return datetime.now(timezone.utc) + timedelta(hours=REGION_CONFIGS[region]["tz"])
 
-    # Initialize notifications
+    # Initialize notifications, shared by all guilds
     def setup_notifications(self, region):
-        self.cronTab = []
-
-        config = self.region_configs[region]
+        config = REGION_CONFIGS[region]
         channelId = config["channelId"]
         tz = config["tz"]
-        role = config["role"]
 
         self.add_notification(
             "30 11,17,20 * * * 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Energy to be claimed! Go go!",
         )
@@ -230,14 +393,14 @@ class StackedBot(discord.Client):
         self.add_notification(
             "0 12 * * 1,4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Dragon is invading! Remember to fix ballista!",
         )
         self.add_notification(
             "30 20 * * 1,4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Dragon is leaving in 30 minutes! Remember to fix ballista!",
         )
@@ -245,7 +408,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "0 21 * * * 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Guild reward packs! Go claim some lewt!",
         )
@@ -253,7 +416,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "45 20 * * * 0", 
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to arena rewards",
         )
@@ -261,7 +424,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "15 21 * * * 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to underground rewards! Go get em castles :partying_face:",
         )
@@ -269,67 +432,67 @@ class StackedBot(discord.Client):
         self.add_notification(
             "0 5 * * 3 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Sphinx is coming today, save up some movement!",
         )
         self.add_notification(
             "0 9 * * 3 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "Sphinx is here, go play trivia!",
         )
         self.add_notification(
             "50 18 * * 6 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
-            f"10 minutes to Holy City Siege starts! Prepare your formations (and don't forget auto battle if you can't play!) {role.mention}",
+            "10 minutes to Holy City Siege starts! Prepare your formations (and don't forget auto battle if you can't play!) {role}",
         )
 
         # KvK
         self.add_notification(
             "45 8 * * 3 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
-            f"15 minutes to KvK starts!! {role.mention}",
+            "15 minutes to KvK starts!! {role}",
         )
         self.add_notification(
             "45 8 * * 4,5 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes till today's KvK rounds start!",
         )
         self.add_notification(
             "45 21 * * 3,4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to KvK rewards! Go get em Kingdoms :partying_face:",
         )
         self.add_notification(
             "45 21 * * 5 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to KvK ends! Go get em Kingdoms :partying_face:",
         )
         self.add_notification(
             "00 19 * * 5 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
-            f"3 Hours to KvK ends! Don't forget to use your sweeps! {role.mention}",
+            "3 Hours to KvK ends! Don't forget to use your sweeps! {role}",
         )
 
         # BoG
         self.add_notification(
             "45 19 * * 2 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to group game in BoG! Remember rosters!",
             StackedBot.bog_week,
@@ -337,7 +500,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "45 19 * * 3 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to Battle of Gods quarter finals! Go place your bets and rosters :partying_face:",
             StackedBot.bog_week,
@@ -345,7 +508,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "45 19 * * 4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to Battle of Gods finals! Go place your bets and rosters :partying_face:",
             StackedBot.bog_week,
@@ -355,7 +518,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "15 19 * * 2 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to qualification games in CoG! Remember rosters!",
             StackedBot.cog_week,
@@ -363,7 +526,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "15 19 * * 3 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to qualification games in CoG  Remember rosters",
             StackedBot.cog_week,
@@ -371,7 +534,7 @@ class StackedBot(discord.Client):
         self.add_notification(
             "15 19 * * 4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             "15 minutes to CoG finals! Go place your bets and rosters :partying_face:",
             StackedBot.cog_week,
@@ -381,14 +544,14 @@ class StackedBot(discord.Client):
         self.add_notification(
             "0 9 * * 1,4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             '"Endless" inferno is here, go climb the ladder!',
         )
         self.add_notification(
             "30 11 * * 1,4 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
             '"Endless" inferno refresh in 30 minutes!',
         )
@@ -415,18 +578,18 @@ class StackedBot(discord.Client):
         self.add_notification(
             "0 5 1 * * 0",
             tz,
-            self.com_channels[channelId],
+            channelId,
             region,
-            f"New premium deck out! Activate it BEFORE starting dailies! {role.mention}",
+            "New premium deck out! Activate it BEFORE starting dailies! {role}",
         )
 
-    # Wrapper for adding notifications
-    def add_notification(self, time, tz, channel, region, message, active=None):
+    # Wrapper for adding notifications, "{role}" in message mentions the region role
+    def add_notification(self, time, tz, channelId, region, message, active=None):
         self.cronTab.append(
             aiocron.crontab(
                 time,
                 func=partial(
-                    StackedBot.send_notification, self, channel, region, message, active
+                    StackedBot.send_notification, self, channelId, region, message, active
                 ),
                 start=True,
                 tz=timezone(timedelta(hours=tz)),
@@ -451,19 +614,38 @@ class StackedBot(discord.Client):
         return not self.cog_week(region)
 
     # Send notifications
-    async def send_notification(self, channel, region, msg, active=None):
-        if active is not None and active(self, region) and channel is not None:
-            await channel.send(f"{msg}")
-        elif active is None and channel is not None:
-            await channel.send(f"{msg}")
-        elif active is None and channel is None:
-            message = f"{msg.capitalize()} store has refreshed"
-            for id in self.remind_me[msg]:
-                user = self.guilds[0].get_member(id)
-                if user and self.region_configs[region]["role"] in user.roles:
-                    await user.send(message)
+    @timed("handler")
+    async def send_notification(self, channelId, region, msg, active=None):
+        if active is not None and not active(self, region):
+            return
+
+        if channelId is not None:
+            for state in self.guild_states.values():
+                config = state.region_configs[region]
+                self.outbound.send(
+                    state.com_channels[channelId],
+                    msg.format(role=config["role"].mention),
+                )
+            return
+
+        # Only walk the guilds and users that asked for this reminder
+        message = f"{msg.capitalize()} store has refreshed"
+        reminded = set()
+        for guild_id, subscribers in self.remind_me.get(msg, {}).items():
+            state = self.guild_states.get(guild_id)
+            if state is None:
+                continue
+            role = state.region_configs[region]["role"]
+            for id in subscribers:
+                if id in reminded:
+                    continue
+                user = state.guild.get_member(id)
+                if user and role in user.roles:
+                    reminded.add(id)
+                    self.outbound.send(user, message)
 
     # Reaction translation stuff
+    @timed("handler")
     async def on_raw_reaction_add(self, reactionEvent):
         country = None
         try:
@@ -489,29 +671,39 @@ class StackedBot(discord.Client):
                 if reaction.emoji == reactionEvent.emoji.name and reaction.count != 1:
                     return
 
-            translated = self.translator.translate(message.content, dest=language)
+            with self.metrics.timer("service", "translator"):
+                translated = self.translator.translate(message.content, dest=language)
 
-            await message.channel.send(
-                f'"{message.content}" in {translated.dest} is: ```{translated.text}```'
+            self.outbound.send(
+                message.channel,
+                f'"{message.content}" in {translated.dest} is: ```{translated.text}```',
             )
         except ValueError as e:
             print(f"tried translate to {language}")
 
             if str(e) == "invalid destination language":
-                await message.channel.send(f"I can't translate into {language} yet!")
+                self.outbound.send(
+                    message.channel, f"I can't translate into {language} yet!"
+                )
         except:
             print(f"tried translate to {language}")
             print(f"msg: {message.reactions}")
 
     # Member join handler
+    @timed("handler")
     async def on_member_join(self, member):
-        await self.com_channels["lobby"].send(
-            f"Hi {member.mention}, welcome to Stacked! :partying_face:"
+        state = self.guild_states.get(member.guild.id)
+        if state is None:
+            return
+        self.outbound.send(
+            state.com_channels["lobby"],
+            f"Hi {member.mention}, welcome to Stacked! :partying_face:",
         )
 
     # Message handler
+    @timed("handler")
     async def on_message(self, message):
-        if message.author == client.user:
+        if message.author == self.user:
             return
 
         mentioned = self.user in message.mentions
@@ -521,18 +713,18 @@ class StackedBot(discord.Client):
         if msg.startswith("!"):
             response = await self.handle_command(msg, message)
             if response is not None:
-                await message.channel.send(f"{response}")
+                self.outbound.send(message.channel, response)
             return
 
-        response = self.chatbot_process(message, reply=mentioned or private)
+        response = await self.chatbot_process(message, reply=mentioned or private)
         if response is not None:
             if not private:
                 response = f"{message.author.mention} {response}"
-            await message.channel.send(response)
+            self.outbound.send(message.channel, response)
 
     # Prepare a response when I'm mentioned! (chatbot)
-    def chatbot_process(self, message, reply=False):
-        msg = self.clean_message(message)
+    async def chatbot_process(self, message, reply=False):
+        msg = clean_message(message)
         if msg is None:
             return None
 
@@ -541,13 +733,18 @@ class StackedBot(discord.Client):
         # sense out of it. Make persistent dictionary, with message ID's from
         # where in each of channels it has read so far. Then hourly, check for updates.
         if reply is False:
-            self.trainer.train([msg])
+            self.chatbot.train(msg)
             return None
 
-        return self.bot.get_response(msg)
+        return await self.chatbot.respond(msg)
 
     # Command switch
     async def handle_command(self, msg, full_message):
+        command = next((c for c in COMMANDS if msg.startswith(f"!{c}")), "unknown")
+        with self.metrics.timer("command", command):
+            return await self.dispatch_command(msg, full_message)
+
+    async def dispatch_command(self, msg, full_message):
         response = None
         if msg.startswith("!help"):
             response = self.help(msg)
@@ -573,8 +770,66 @@ class StackedBot(discord.Client):
             response = self.handle_remind_me(full_message)
         elif msg.startswith("!role"):
             response = await self.handle_role(full_message)
+        elif msg.startswith("!stats"):
+            response = self.stats(full_message)
+        elif msg.startswith("!profile"):
+            response = self.handle_profile(full_message)
         return response
 
+    # Admins are server administrators and the users listed in ADMIN_IDS
+    def is_admin(self, member):
+        if member.id in ADMIN_IDS:
+            return True
+        permissions = getattr(member, "guild_permissions", None)
+        return permissions is not None and permissions.administrator
+
+    # Handler, command and service latencies
+    def stats(self, message):
+        if not self.is_admin(message.author):
+            return "Only admins can see my stats"
+        # A code block per section, the outbound queue packs them into as few
+        # messages as fit without cutting one in two
+        sections = self.metrics.summary(limit=DISCORD_CHAR_LIMIT - len("```\n\n```"))
+        if not sections:
+            return "Nothing measured yet"
+        for section in sections[:-1]:
+            self.outbound.send(message.channel, f"```\n{section}\n```")
+        return f"```\n{sections[-1]}\n```"
+
+    # Start a profile of the running bot
+    def handle_profile(self, message):
+        if not self.is_admin(message.author):
+            return "Only admins can profile me"
+        components = message.content.split()
+        try:
+            seconds = int(components[1]) if len(components) > 1 else PROFILE_SECONDS
+        except ValueError:
+            return "Usage: !profile <Seconds=[Default:30]>"
+        if seconds < 1 or seconds > PROFILE_MAX_SECONDS:
+            return f"I can profile for 1 to {PROFILE_MAX_SECONDS} seconds"
+        # Claimed here on the loop, so a second !profile can't slip in
+        if not self.profiler.claim():
+            return "Already profiling, hang on"
+
+        asyncio.ensure_future(self.profile(seconds, message.channel, claimed=True))
+        return f"Profiling for {seconds} seconds..."
+
+    # Sample stacks off the event loop and report where the profile went
+    async def profile(self, seconds, channel=None, claimed=False):
+        if not claimed and not self.profiler.claim():
+            print("A profile is already running")
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            path = await loop.run_in_executor(None, self.profiler.run, seconds, True)
+        except (OSError, RuntimeError) as e:
+            print(f"Profiling failed: {e}")
+            if channel is not None:
+                self.outbound.send(channel, f"Profiling failed: {e}")
+            return
+        if channel is not None:
+            self.outbound.send(channel, f"Profile written to {path}")
+
     # Reminder registration
     def handle_remind_me(self, message):
         valid_events = ["emblem", "mystical"]
@@ -586,14 +841,33 @@ class StackedBot(discord.Client):
         if event_name not in valid_events:
             return "Don't know that event..."
 
-        if event_name not in self.remind_me:
-            self.remind_me[event_name] = []
+        # In private, (un)subscribe in every guild we share
+        if message.guild is not None:
+            if message.guild.id not in self.guild_states:
+                return "I don't send reminders for this server"
+            guild_ids = [message.guild.id]
+        else:
+            guild_ids = [
+                guild_id
+                for guild_id, state in self.guild_states.items()
+                if state.guild.get_member(message.author.id) is not None
+            ]
+            if not guild_ids:
+                return "We're not in any server I send reminders for"
 
-        if message.author.id in self.remind_me[event_name]:
-            self.remind_me[event_name].remove(message.author.id)
+        if event_name not in self.remind_me:
+            self.remind_me[event_name] = {}
+        subscribers = self.remind_me[event_name]
+
+        # Changed in place, let the persister know
+        self.remind_me.touch()
+        if any(message.author.id in subscribers.get(id, ()) for id in guild_ids):
+            for id in guild_ids:
+                subscribers.get(id, set()).discard(message.author.id)
             return f"I'll stop reminding you of {event_name}"
         else:
-            self.remind_me[event_name].append(message.author.id)
+            for id in guild_ids:
+                subscribers.setdefault(id, set()).add(message.author.id)
             return f"I'll remind you of {event_name}"
 
     # Role registration
@@ -607,7 +881,11 @@ class StackedBot(discord.Client):
         if role_name not in valid_roles:
             return "Don't know that role... (supported 'EU' and 'NA')"
 
-        role = self.region_configs[Region[role_name.upper()]]["role"]
+        state = self.guild_states.get(getattr(message.guild, "id", None))
+        if state is None:
+            return "I can only do that in a server I'm set up for"
+
+        role = state.region_configs[Region[role_name.upper()]]["role"]
         if role in message.author.roles:
             await message.author.remove_roles(role)
             return f"I'll stop notifying you of {role_name} events"
@@ -621,6 +899,7 @@ class StackedBot(discord.Client):
         response += "!event <Region=[Default:EU, NA]> - Todays events\n"
         response += "!events <Region=[Default:EU, NA]> - This weeks events\n"
         response += "!whatis <keyword> - Explains what keyword is\n"
+        response += "!whatis <prefix>* - Lists what I know starting with prefix\n"
         response += "!addis <keyword> <explanation> - Teach me what keyword means\n"
         response += "!remis <keyword> - Deletes my knowledge of keyword\n"
         response += (
@@ -635,6 +914,8 @@ class StackedBot(discord.Client):
         response += "!inspireme - I'll generate an inspirational quote\n"
         response += "!remindme <event> - I'll notify you about event in pm\n"
         response += "!role <EU/NA> - I'll notify you about events for that region in pm\n"
+        response += "!stats - Response times and load (admins only)\n"
+        response += "!profile <seconds> - Profile me for a while (admins only)\n"
         response += "Mention me and I'll respond something stupid :partying_face:"
 
         return response
@@ -643,19 +924,40 @@ class StackedBot(discord.Client):
     def handle_is(self, message):
         if message.startswith("!whatis"):
             keyword = message.split()[1].lower()
-            if keyword in self.whatis:
-                return f"{keyword} refers to {self.whatis[keyword]}"
-            else:
-                return f"I don't know what {keyword} means..."
+            if keyword.endswith("*"):
+                return self.list_whatis(keyword[:-1])
+            meaning = self.whatis.get(keyword)
+            if meaning is not None:
+                return f"{keyword} refers to {meaning}"
+
+            suggestions = self.glossary.similar(keyword)
+            if suggestions:
+                return (
+                    f"I don't know what {keyword} means... "
+                    f"did you mean {', '.join(suggestions)}?"
+                )
+            return f"I don't know what {keyword} means..."
         elif message.startswith("!addis"):
             meh, keyword, meaning = message.split(" ", 2)
             self.whatis[keyword.lower()] = meaning
+            self.glossary.add(keyword.lower())
             return f"Thanks for letting me know what {keyword} means"
         elif message.startswith("!remis"):
             keyword = message.split()[1].lower()
             del self.whatis[keyword]
+            self.glossary.remove(keyword)
             return f"I've forgotten what {keyword} means"
 
+    # Everything I know starting with prefix
+    def list_whatis(self, prefix, limit=20):
+        keywords, total = self.glossary.complete(prefix, limit)
+        if not keywords:
+            return f"I don't know anything starting with {prefix}..."
+        response = f"I know about: {', '.join(keywords)}"
+        if total > len(keywords):
+            response += f" and {total - len(keywords)} more"
+        return response
+
     # Do a wiki lookup
     def wikipedia_lookup(self, query):
         keywords = query.split(" ", 1)
@@ -664,6 +966,11 @@ class StackedBot(discord.Client):
 
         keyword = keywords[1]
 
+        with self.metrics.timer("service", "wikipedia"):
+            return self.wikipedia_summary(keyword)
+
+    # First sentence of the best matching article
+    def wikipedia_summary(self, keyword):
         try:
             return wikipedia.summary(keyword).split(".")[0]
         except Exception:
@@ -695,7 +1002,10 @@ class StackedBot(discord.Client):
                 "x-rapidapi-key": f"{URBAN_DICTIONARY_API_KEY}",
                 "x-rapidapi-host": "mashape-community-urban-dictionary.p.rapidapi.com",
             }
-            response = requests.request("GET", url, headers=headers, params=querystring)
+            with self.metrics.timer("service", "urban"):
+                response = requests.request(
+                    "GET", url, headers=headers, params=querystring
+                )
             response_list = json.loads(response.content)["list"]
             item = max(response_list, key=lambda item: int(item["thumbs_up"]))
             result = (
@@ -709,7 +1019,8 @@ class StackedBot(discord.Client):
     def inspireme(self, message):
         """inspirobot.me quote"""
         try:
-            quote = inspirobot.generate()  # Generate Image
+            with self.metrics.timer("service", "inspirobot"):
+                quote = inspirobot.generate()  # Generate Image
             return quote.url
         except Exception as ex:
             pass
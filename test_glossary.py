@@ -0,0 +1,103 @@
+import random
+import time
+
+from glossary import GlossaryIndex, bounded_edit_distance, max_typos
+
+
+def test_complete():
+    index = GlossaryIndex(["kvk", "kvkcalc", "kill", "dragon"])
+    assert index.complete("kv") == (["kvk", "kvkcalc"], 2)
+    assert index.complete("k", limit=2) == (["kill", "kvk"], 3)
+    assert index.complete("x") == ([], 0)
+
+
+def test_similar():
+    index = GlossaryIndex(["battle", "dragon", "bog", "kvk"])
+    # One typo for short keys
+    assert index.similar("kvj") == ["kvk"]
+    assert index.similar("bgo") == ["bog"]
+    assert index.similar("kxj") == []
+    # Two for longer ones: substitutions, insertions and a mix
+    assert index.similar("bsttke") == ["battle"]
+    assert index.similar("dragonnn") == ["dragon"]
+    assert index.similar("xbattly") == ["battle"]
+    assert index.similar("dargonn") == ["dragon"]
+
+
+def test_similar_closest_first():
+    index = GlossaryIndex(["dragons", "dragon", "wagon"])
+    assert index.similar("dragno") == ["dragon", "dragons"]
+    assert index.similar("dragno", limit=1) == ["dragon"]
+
+
+def test_remove():
+    index = GlossaryIndex(["battle", "battles", "dragon", "kvk"])
+    index.remove("battles")
+    index.remove("unknown")
+    assert "battles" not in index
+    assert len(index) == 3
+    assert index.complete("bat") == (["battle"], 1)
+    assert index.similar("battlez") == ["battle"]
+    # Nothing of the removed key is left behind
+    assert index.find("battles") is None
+    clean = GlossaryIndex(["battle", "dragon", "kvk"])
+    assert index.deletions == clean.deletions
+    assert index.blocks == clean.blocks
+
+
+def test_bounded_edit_distance():
+    assert bounded_edit_distance("bog", "bgo", 1) == 1
+    assert bounded_edit_distance("battle", "bsttke", 2) == 2
+    assert bounded_edit_distance("battle", "dragon", 2) is None
+
+
+def random_terms(count, seed=1):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    terms = set()
+    while len(terms) < count:
+        terms.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 12))))
+    return sorted(terms), rng
+
+
+def typo(term, rng):
+    chars = list(term)
+    for _ in range(2):
+        i = rng.randrange(len(chars) - 1)
+        op = rng.randrange(4)
+        if op == 0:
+            chars[i] = "z"
+        elif op == 1:
+            chars.insert(i, "q")
+        elif op == 2:
+            del chars[i]
+        else:
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return "".join(chars)
+
+
+def test_similar_finds_everything():
+    terms, rng = random_terms(2000)
+    index = GlossaryIndex(terms)
+    for term in rng.sample(terms, 100):
+        key = typo(term, rng)
+        typos = max_typos(key)
+        expected = sorted(
+            (distance, other)
+            for other in terms
+            if other != key
+            for distance in [bounded_edit_distance(key, other, typos)]
+            if distance is not None
+        )
+        assert index.similar(key, limit=len(terms)) == [other for _, other in expected]
+
+
+def test_similar_fast():
+    terms, rng = random_terms(20000)
+    index = GlossaryIndex(terms)
+    keys = [typo(term, rng) for term in rng.sample(terms, 200)]
+    start = time.perf_counter()
+    for key in keys:
+        index.similar(key)
+    # Well under a millisecond on average, with room for slow machines
+    assert (time.perf_counter() - start) / len(keys) < 0.002
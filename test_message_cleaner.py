@@ -0,0 +1,46 @@
+from benchmark_clean import Channel, Guild, Member, Message, Role, legacy_clean_message
+from message_cleaner import clean_message
+
+STACKED = Member(100000000000000001, "Stacked")
+ALICE = Member(100000000000000002, "alice", nick="Alice")
+EU = Role(100000000000000003, "EU")
+LOBBY = Channel(100000000000000004, "lobby")
+GUILD = Guild([STACKED, ALICE], [EU], [LOBBY])
+
+
+# Same text as StackedBot.clean_message used to give
+def check(message, expected):
+    assert clean_message(message) == expected
+    assert legacy_clean_message(message) == expected
+
+
+def test_quote():
+    check(Message("> what time is it", GUILD), None)
+    check(Message("> what time is it\nno idea\nsorry", GUILD), "no idea")
+
+
+def test_leading_mention():
+    check(Message(f"<@!{STACKED.id}> hi there", GUILD, [STACKED]), " hi there")
+    check(Message(f"<@{STACKED.id}>hi", GUILD, [STACKED]), "hi")
+
+
+def test_role_ping():
+    check(Message(f"<@&{EU.id}> dragon tonight", GUILD, role_mentions=[EU]), "dragon tonight")
+    check(Message(f"<@&{EU.id}>", GUILD, role_mentions=[EU]), None)
+
+
+def test_channel():
+    check(
+        Message(f"see you in <#{LOBBY.id}>", GUILD, channel_mentions=[LOBBY]),
+        "see you in #lobby",
+    )
+
+
+def test_private():
+    # No guild to look members up in, the mentions of the message name them
+    check(Message(f"hi <@{ALICE.id}>", None, [ALICE]), "hi Alice")
+
+
+def test_lone_at():
+    check(Message("@everyone", GUILD), None)
+    check(Message("@here gg all", GUILD), "gg all")
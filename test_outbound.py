@@ -0,0 +1,30 @@
+from outbound import coalesce, split_message
+
+
+def test_split_message():
+    # Short enough, left alone
+    assert split_message("hello there", limit=20) == ["hello there"]
+    # Cut at the last line break that fits, then at a space, else anywhere
+    assert split_message("first line\nsecond line", limit=15) == ["first line", "second line"]
+    assert split_message("first second third", limit=12) == ["first second", "third"]
+    assert split_message("abcdefghij", limit=4) == ["abcd", "efgh", "ij"]
+    # Every piece fits
+    text = "word " * 1000
+    assert all(0 < len(chunk) <= 2000 for chunk in split_message(text))
+
+
+def test_split_message_blank():
+    assert split_message("") == []
+    assert split_message("   ") == []
+    assert split_message("\n" * 3000) == []
+    assert [chunk.strip() for chunk in split_message("hi" + "\n" * 3000, limit=10)] == ["hi"]
+
+
+def test_coalesce():
+    # Merged up to the limit, line by line
+    assert coalesce(["a", "b", "c"]) == ["a\nb\nc"]
+    assert coalesce(["aaaa", "bbbb", "cccc"], limit=9) == ["aaaa\nbbbb", "cccc"]
+    # Long messages are split first, the tail merges with what follows
+    assert coalesce(["aaaa bbbb", "cc"], limit=7) == ["aaaa", "bbbb\ncc"]
+    assert coalesce(["hi", " \n "]) == ["hi"]
+    assert coalesce([]) == []
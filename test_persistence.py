@@ -0,0 +1,77 @@
+import asyncio
+import os
+import shelve
+import time
+
+from persistence import PersistentDict, Persister
+
+
+def test_snapshot_write_and_restore(tmp_path):
+    path = str(tmp_path / "whatis")
+    store = PersistentDict(path)
+    store["kvk"] = "kingdom vs kingdom"
+    assert store.dirty
+    size = store.write(store.snapshot())
+    assert size == os.path.getsize(f"{path}.snapshot")
+
+    # Written again, the snapshot is replaced and no temp file is left over
+    store["bog"] = "battle of gods"
+    store.write(store.snapshot())
+    assert os.listdir(tmp_path) == ["whatis.snapshot"]
+
+    restored = PersistentDict(path)
+    assert dict(restored) == {"kvk": "kingdom vs kingdom", "bog": "battle of gods"}
+    assert not restored.dirty
+
+
+def test_migrate_from_shelve(tmp_path):
+    path = str(tmp_path / "whatis")
+    with shelve.open(path) as shelf:
+        shelf["kvk"] = "kingdom vs kingdom"
+
+    store = PersistentDict(path)
+    assert dict(store) == {"kvk": "kingdom vs kingdom"}
+    # Written to a snapshot on the next flush
+    assert store.dirty
+    asyncio.run(Persister({"whatis": store}).flush())
+    assert not store.dirty
+    assert dict(PersistentDict(path)) == {"kvk": "kingdom vs kingdom"}
+
+
+def test_snapshot_copies_values(tmp_path):
+    store = PersistentDict(str(tmp_path / "reminder"), copy_value=set)
+    store["emblem"] = {1, 2}
+    snapshot = store.snapshot()
+    # Changed in place after the copy, the snapshot keeps what it had
+    store["emblem"].add(3)
+    store.touch()
+    assert snapshot == {"emblem": {1, 2}}
+    assert store.dirty
+
+
+def test_stop_during_flush(tmp_path):
+    path = str(tmp_path / "whatis")
+    store = PersistentDict(path)
+    write = store.write
+
+    def slow_write(data):
+        time.sleep(0.2)
+        return write(data)
+
+    store.write = slow_write
+
+    async def run():
+        persister = Persister({"whatis": store}, interval=0.01)
+        store["kvk"] = "kingdom vs kingdom"
+        persister.start()
+        # Stopped while the periodic flush is still writing
+        await asyncio.sleep(0.05)
+        store["bog"] = "battle of gods"
+        await asyncio.wait_for(persister.stop(), 2)
+
+    asyncio.run(run())
+    assert not store.dirty
+    assert dict(PersistentDict(path)) == {
+        "kvk": "kingdom vs kingdom",
+        "bog": "battle of gods",
+    }